@@ -1,18 +1,21 @@
 import numpy as np
 
-def apply_corrections(data, operator, station_rigidity, data_keys):
+def apply_corrections(data, operator, station_rigidity, data_keys, reference=None):
     """
     main function for the corrections module. Takes data and an operator string, finds what corrections to apply and
     applies them
     :param station_rigidity: cutoff rigidity if GV of station taking measurements
     :param data: dataframe containing data to be corrected and correction data
     :param operator: string specifying the network operator
+    :param reference: optional row of a reference table (see make_reference_row) holding the long term
+    'ReferencePressure', 'ReferenceHumidity' and 'AttenuationLength' of the station. If None the means of the data
+    passed are used as the references
     :return: dataframe containing corrected data
     """
     # get the keys of data to correct
     correction_key_dict = set_corr_keys(operator)
     # get the correction factors
-    correction_factors = get_corr_factors(data, correction_key_dict, station_rigidity)
+    correction_factors = get_corr_factors(data, correction_key_dict, station_rigidity, reference)
     # correct the data
     for key in data_keys:
         data[key] = data[key] * correction_factors['p_corr'] * correction_factors['h_corr']
@@ -22,7 +25,7 @@ def apply_corrections(data, operator, station_rigidity, data_keys):
 def set_corr_keys(operator):
     """
     function to accept an operator string and return the dataframe keys in a dictionary
-    :param operator: string specifying the operator, must be 'COSMOS-UK' or 'COSMOS-US'
+    :param operator: string specifying the operator, must be 'COSMOS-UK', 'COSMOS-US' or 'NMDB'
     :return: dictionary containing the pressure and humidity correction keys
 
     """
@@ -30,27 +33,35 @@ def set_corr_keys(operator):
         key_dict = {'p_corr': 'PRESS', 'h_corr': None}
     elif "COSMOS-UK" == operator:
         key_dict = {'p_corr': 'PA', 'h_corr': 'Q'}
+    elif "NMDB" == operator:
+        # NMDB count rates are already corrected for pressure by the stations
+        key_dict = {'p_corr': None, 'h_corr': None}
     else:
         raise KeyError('%s is not a valid operator key' % operator)
 
     return key_dict
 
 
-def get_corr_factors(data, key_dict, station_rigidity):
+def get_corr_factors(data, key_dict, station_rigidity, reference=None):
     """
     takes some data and an operator and returns correction factors
     :param station_rigidity: cutoff rigidity of station taking measurements (GV)
     :param data: dataframe containing data and correction data
     :param key_dict: dictionary containing correction keys
+    :param reference: optional reference table row for the station, see apply_corrections
     :return: dictionary containing the correction factors
     """
+    if reference is None:
+        reference = {'ReferencePressure': None, 'ReferenceHumidity': None, 'AttenuationLength': None}
+
     if key_dict['p_corr'] is not None:
-        p_corr = pressure_correction(data[key_dict['p_corr']], station_rigidity)
+        p_corr = pressure_correction(data[key_dict['p_corr']], station_rigidity, reference['ReferencePressure'],
+                                     reference['AttenuationLength'])
     else:
         p_corr = np.full(len(data), 1)
 
     if key_dict['h_corr'] is not None:
-        h_corr = humidity_correction(data[key_dict['h_corr']])
+        h_corr = humidity_correction(data[key_dict['h_corr']], reference['ReferenceHumidity'])
     else:
         h_corr = np.full(len(data), 1)
 
@@ -59,18 +70,22 @@ def get_corr_factors(data, key_dict, station_rigidity):
     return ret_dict
 
 
-def pressure_correction(pressure, rigidity):
+def pressure_correction(pressure, rigidity, p_0=None, mass_attenuation_length=None):
     """
     function to get pressure correction factors, given a pressure time series and rigidity value for the station
     :param pressure: time series of pressure values over the time of the data observations
     :param rigidity: cut-off rigidity of the station making the observations
+    :param p_0: reference pressure. If None the mean of the pressure series is used
+    :param mass_attenuation_length: attenuation length at the reference pressure. If None it is calculated
     :return: series of correction factors
     """
-    p_0 = np.nanmean(pressure)
+    if p_0 is None:
+        p_0 = np.nanmean(pressure)
 
     pressure_diff = pressure - p_0
     # g cm^-2. See Desilets & Zreda 2003
-    mass_attenuation_length = attenuation_length(p_0, rigidity)
+    if mass_attenuation_length is None:
+        mass_attenuation_length = attenuation_length(p_0, rigidity)
 
     exponent = pressure_diff * mass_attenuation_length
 
@@ -79,14 +94,16 @@ def pressure_correction(pressure, rigidity):
     return pressure_corr
 
 
-def humidity_correction(humidity):
+def humidity_correction(humidity, mean_hum=None):
     """
 
     :param humidity:
+    :param mean_hum: reference humidity. If None the mean of the humidity series is used
     :return:
     """
 
-    mean_hum = np.nanmean(humidity)
+    if mean_hum is None:
+        mean_hum = np.nanmean(humidity)
     hum_change = humidity - mean_hum
 
     hum_corr = 1 + (0.0054 * hum_change)
@@ -94,6 +111,34 @@ def humidity_correction(humidity):
     return hum_corr
 
 
+def make_reference_row(data, operator, station_rigidity):
+    """
+    function to calculate the long term correction references of a station from its full record
+    :param data: dataframe containing the full record of correction data for the station
+    :param operator: string specifying the network operator
+    :param station_rigidity: cutoff rigidity of the station (GV)
+    :return: dictionary containing the reference pressure, reference humidity and the attenuation length at the
+    reference pressure. References the operator does not correct for are NaN
+    """
+    key_dict = set_corr_keys(operator)
+
+    if key_dict['p_corr'] is not None:
+        p_ref = np.nanmean(data[key_dict['p_corr']])
+        beta = attenuation_length(p_ref, station_rigidity)
+    else:
+        p_ref = np.nan
+        beta = np.nan
+
+    if key_dict['h_corr'] is not None:
+        h_ref = np.nanmean(data[key_dict['h_corr']])
+    else:
+        h_ref = np.nan
+
+    ret_dict = {'ReferencePressure': p_ref, 'ReferenceHumidity': h_ref, 'AttenuationLength': beta}
+
+    return ret_dict
+
+
 def attenuation_length(pressure, rigidity):
     """
 
@@ -1,13 +1,16 @@
 import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from tqdm import tqdm
 import numpy as np
 from datahandling.import_data import import_neutron_data
-from coscal.correct_data import apply_corrections
+from coscal.correct_data import apply_corrections, make_reference_row, attenuation_length, set_corr_keys
 
 
 def average_neutron_data(folder_path, operator, start_date, stop_date, rigidity_range={'min': 0, 'max': 20},
-                         original_frequency='3600s', new_frequency='3600s', excluded_stations=[]):
+                         original_frequency='3600s', new_frequency='3600s', excluded_stations=[],
+                         use_reference_table=False, metafile_format=None, baseline_duration='48h'):
     """
 
     :param excluded_stations:
@@ -19,77 +22,443 @@ def average_neutron_data(folder_path, operator, start_date, stop_date, rigidity_
     :param stop_date: pandas datetime containing the end date of the range of data to be averaged
     :param rigidity_range: list containing floats specifying the lower and upper range of rigidities for data to be
      accepted [lower_limit, upper_limit]
-    :param frequency: the time resolution of the averaged data
-    :return: averaged data as a pandas dataframe
+    :param new_frequency: the time resolution of the averaged data (anything pd.Timedelta accepts), or a list of
+    resolutions. The data is ingested and corrected once at the original frequency and every resolution is aggregated
+    from that in the same way, so a resolution gives the same curve whether or not others are asked for alongside it.
+    Time bins that are only partly covered by the data are dropped
+    :param use_reference_table: if True correct each station with the long term references stored in the folder by
+    make_reference_table, rather than the means of the event window
+    :param metafile_format: optional dictionary overriding the metafile keys from get_other_keys
+    :param baseline_duration: length of time at the start of the data used as the relative change baseline
+    :return: averaged data as a pandas dataframe, or a dictionary of dataframes keyed by frequency if a list of
+    frequencies was given
+    """
+    # a single frequency keeps the original return type
+    multi_resolution = isinstance(new_frequency, (list, tuple))
+    if multi_resolution:
+        frequencies = list(new_frequency)
+    else:
+        frequencies = [new_frequency]
+    # ingest and correct the data at the original frequency
+    for frequency in frequencies:
+        if not is_multiple(pd.Timedelta(frequency), pd.Timedelta(original_frequency)):
+            raise ValueError('Every frequency must be a multiple of the original frequency %s' % original_frequency)
+
+    all_data, index, contributing_stations = collect_station_data(folder_path, operator, start_date, stop_date,
+                                                                  rigidity_range, original_frequency,
+                                                                  original_frequency,
+                                                                  excluded_stations, use_reference_table,
+                                                                  metafile_format)
+    data_keys = get_data_keys(operator)
+    resampler_dict = get_resampler_dict(operator)
+
+    averages = {}
+    for frequency in frequencies:
+        # the relative change baseline covers the same time span at every resolution
+        baseline_length = max(1, int(pd.Timedelta(baseline_duration) / pd.Timedelta(frequency)))
+        agg_data, agg_index = aggregate_data_dict(all_data, index, data_keys, frequency, resampler_dict,
+                                                  original_frequency)
+        averages[frequency] = make_average_frame(agg_data, agg_index, data_keys, baseline_length)
+
+    if multi_resolution:
+        return averages, contributing_stations
+
+    return averages[new_frequency], contributing_stations
+
+
+def collect_station_data(folder_path, operator, start_date, stop_date, rigidity_range, original_frequency,
+                         new_frequency, excluded_stations, use_reference_table=False, metafile_format=None):
+    """
+    function to import, resample, QC check, correct and clean the data from every accepted station in a folder, and
+    stack it into a station x time array for each data key
+    :param folder_path: string containing system path to folder containing the data and the station_info.txt metafile
+    :param operator: string specifying the operator of the network supplying the data
+    :param start_date: pandas datetime containing the start date of the range of data
+    :param stop_date: pandas datetime containing the end date of the range of data
+    :param rigidity_range: dictionary with 'min' and 'max' cutoff rigidities for stations to be accepted
+    :param original_frequency: string containing the original frequency of the data
+    :param new_frequency: string specifying the frequency to which each station is resampled
+    :param excluded_stations: list of station names to skip
+    :param use_reference_table: if True correct with the references stored in the folder by make_reference_table.
+    Stations missing from the table are corrected with the event window means, with a warning
+    :param metafile_format: optional dictionary overriding the metafile keys from get_other_keys
+    :return: dictionary of 2D arrays (station x time) keyed by data key, the time index and a dictionary of the
+    contributing station names and rigidities
+    """
+    stations = list_stations(folder_path, operator, rigidity_range, excluded_stations, use_reference_table,
+                             metafile_format)
+    results = process_stations(stations, start_date, stop_date, original_frequency, new_frequency)
+
+    data_keys = get_data_keys(operator)
+    rows = {key: [] for key in data_keys}
+    contributing_stations = {'name': [], 'rigidity': []}
+    index = None
+    for station, station_data in zip(stations, results):
+        if station_data is None:
+            continue
+        contributing_stations['name'].append(station['name'])
+        contributing_stations['rigidity'].append(station['rigidity'])
+
+        # add data to the rows to be averaged - this probably needs a new function too because the difference in
+        # moderated and unmoderated counts from different networks
+        if index is None:
+            index = station_data.index
+        for key in data_keys:
+            rows[key].append(station_data[key].values)
+
+    if index is None:
+        raise ValueError('No valid stations found in %s for the rigidity range and dates given' % folder_path)
+
+    # stack once at the end rather than growing the arrays station by station
+    all_data = {key: np.vstack(rows[key]) for key in data_keys}
+
+    return all_data, index, contributing_stations
+
+
+def read_station_info(folder_path, operator, metafile_format=None):
+    """
+    function to read the station_info.txt metafile in a data folder
+    :param folder_path: string containing system path to folder containing the data and the station_info.txt metafile
+    :param operator: string specifying the operator of the network supplying the data
+    :param metafile_format: optional dictionary overriding the metafile keys from get_other_keys
+    :return: dictionary containing arrays of the station 'name', 'rigidity' and data file path 'filename', and the
+    dictionary of metafile keys
     """
-    metafile_name = 'station_info.txt'
-    # check that the folder at the location exists - if not ask user to correct or exit
     folder_path = check_path_exists(folder_path)
-    # navigate to the directory
-    os.chdir(folder_path)
-    other_keys = get_other_keys(operator)
-    metafile_name = check_path_exists(metafile_name)
+    other_keys = get_other_keys(operator, metafile_format)
+    metafile_name = check_path_exists(os.path.join(folder_path, 'station_info.txt'))
     # read the meta data file
     station_info = pd.read_table(metafile_name, sep=other_keys['meta_sep'])
     # extract the station names from the file
     names = station_info[other_keys['name_column']].values
-    rigidity_list = station_info['CutoffRigidity'].values
-    # initialise array of data to be averaged
-    data_keys = get_data_keys(operator)
-    error_keys = get_error_keys(operator)
-    contributing_stations = {'name': [], 'rigidity': []}
 
-    length = (stop_date - start_date)/pd.Timedelta(new_frequency) + other_keys['length_mod']
-    # loop through every file in the folder
-    first_station = True
-    for i in tqdm(range(0, len(names))):
-        # skip if station is in the excluded list
-        if names[i] in excluded_stations:
+    info = {'name': names,
+            'rigidity': station_info['CutoffRigidity'].values,
+            'filename': [os.path.join(folder_path, str(name) + other_keys['extension']) for name in names]
+            }
+
+    return info, other_keys
+
+
+def list_stations(folder_path, operator, rigidity_range, excluded_stations, use_reference_table=False,
+                  metafile_format=None):
+    """
+    function to list the stations in a folder that are not excluded and are inside the rigidity range
+    :param folder_path: string containing system path to folder containing the data and the station_info.txt metafile
+    :param operator: string specifying the operator of the network supplying the data
+    :param rigidity_range: dictionary with 'min' and 'max' cutoff rigidities for stations to be accepted
+    :param excluded_stations: list of station names to skip
+    :param use_reference_table: if True attach each station's row of the folder's correction_reference.csv (see
+    get_station_reference). Ignored for operators that apply no corrections, which need no table
+    :param metafile_format: optional dictionary overriding the metafile keys from get_other_keys
+    :return: list of dictionaries describing each station, for process_station
+    """
+    info, other_keys = read_station_info(folder_path, operator, metafile_format)
+    # operators like NMDB that are not corrected here have no use for a reference table
+    correction_key_dict = set_corr_keys(operator)
+    use_reference_table = use_reference_table and (correction_key_dict['p_corr'] is not None
+                                                   or correction_key_dict['h_corr'] is not None)
+    if use_reference_table:
+        reference_file_name = os.path.join(folder_path, 'correction_reference.csv')
+        if not os.path.exists(reference_file_name):
+            raise FileNotFoundError('No correction reference table at %s. Build it with make_reference_table first'
+                                    % reference_file_name)
+        reference_table = pd.read_csv(reference_file_name, index_col=0)
+
+    stations = []
+    for name, rigidity, filename in zip(info['name'], info['rigidity'], info['filename']):
+        # skip if station is in the excluded list or outside the rigidity range
+        if name in excluded_stations:
             continue
-        # create the filename
-        filename = names[i] + other_keys['extension']
-        rigidity = rigidity_list[i]
-        # open the file
         if not np.logical_and(rigidity >= rigidity_range['min'], rigidity <= rigidity_range['max']):
             continue
-        station_data, valid = import_neutron_data(filename, operator, start_date, stop_date)
+        if use_reference_table:
+            reference = get_station_reference(reference_table, name, rigidity, operator)
+        else:
+            reference = None
+
+        stations.append({'name': name, 'rigidity': rigidity, 'filename': filename, 'operator': operator,
+                         'length_mod': other_keys['length_mod'], 'count_rate': other_keys['count_rate'],
+                         'reference': reference})
+
+    return stations
+
+
+def get_station_reference(reference_table, name, rigidity, operator):
+    """
+    function to get a station's row of a reference table from make_reference_table. A station missing from the table,
+    or with a NaN reference for a correction its operator applies, falls back to the event window means. A station
+    whose rigidity has changed since the table was built has its attenuation length recalculated at the new rigidity.
+    Each case raises a warning
+    :param reference_table: dataframe of references indexed by station name
+    :param name: station name
+    :param rigidity: the station's current cutoff rigidity from station_info.txt
+    :param operator: string specifying the operator of the network, to find which references are needed
+    :return: the station's references, or None to use the event window means
+    """
+    if name not in reference_table.index:
+        warnings.warn('%s is not in the correction reference table, using the event window means instead. Rebuild '
+                      'the table with make_reference_table' % name)
+        return None
+
+    reference = reference_table.loc[name].copy()
+    # a record without any valid pressure or humidity would turn every corrected point into NaN
+    correction_key_dict = set_corr_keys(operator)
+    needed = []
+    if correction_key_dict['p_corr'] is not None:
+        needed.append('ReferencePressure')
+    if correction_key_dict['h_corr'] is not None:
+        needed.append('ReferenceHumidity')
+    missing = [key for key in needed if pd.isna(reference[key])]
+    if missing:
+        warnings.warn('%s has no valid %s in the correction reference table, using the event window means instead'
+                      % (name, ' or '.join(missing)))
+        return None
+
+    if not np.isclose(reference['CutoffRigidity'], rigidity):
+        warnings.warn('The cutoff rigidity of %s has changed from %s to %s since the correction reference table was '
+                      'built, recalculating its attenuation length. Rebuild the table with make_reference_table'
+                      % (name, reference['CutoffRigidity'], rigidity))
+        reference['AttenuationLength'] = attenuation_length(reference['ReferencePressure'], rigidity)
+        reference['CutoffRigidity'] = rigidity
+
+    return reference
+
+
+def process_stations(stations, start_date, stop_date, original_frequency, new_frequency, num_workers=1):
+    """
+    function to run process_station over a list of stations, which may come from several networks. With more than
+    one worker the files are read and corrected in a thread pool so that the I/O of different stations overlaps
+    :param stations: list of station dictionaries from list_stations
+    :param start_date: pandas datetime containing the start date of the range of data
+    :param stop_date: pandas datetime containing the end date of the range of data
+    :param original_frequency: string containing the original frequency of the data, or a dictionary of strings keyed
+    by operator
+    :param new_frequency: string specifying the frequency to which each station is resampled
+    :param num_workers: number of threads to use
+    :return: list of the processed dataframes (or None for rejected stations) in the same order as stations
+    """
+    def process(station):
+        return process_station(station, start_date, stop_date, original_frequency, new_frequency)
+
+    if num_workers > 1:
+        with ThreadPoolExecutor(num_workers) as executor:
+            return list(tqdm(executor.map(process, stations), total=len(stations)))
+
+    return [process(station) for station in tqdm(stations)]
+
+
+def process_station(station, start_date, stop_date, original_frequency, new_frequency):
+    """
+    function to import, resample, QC check, correct and clean the data of one station
+    :param station: station dictionary from list_stations
+    :param start_date: pandas datetime containing the start date of the range of data
+    :param stop_date: pandas datetime containing the end date of the range of data
+    :param original_frequency: string containing the original frequency of the data, or a dictionary of strings keyed
+    by operator
+    :param new_frequency: string specifying the frequency to which the station is resampled
+    :return: dataframe of the corrected data, or None if the station's data is invalid or incomplete
+    """
+    operator = station['operator']
+    if isinstance(original_frequency, dict):
+        original_frequency = original_frequency[operator]
+    data_keys = get_data_keys(operator)
+    length = (stop_date - start_date)/pd.Timedelta(new_frequency) + station['length_mod']
+
+    station_data, valid = import_neutron_data(station['filename'], operator, start_date, stop_date)
+    # if the data is invalid
+    if not valid or station_data.empty:
+        return None
+    # turn count rates into counts per time step so that summing and poisson errors are valid
+    if station['count_rate']:
+        station_data[data_keys] = station_data[data_keys] * pd.Timedelta(original_frequency).total_seconds()
+    # resample the data
+    station_data = resample_data(station_data, operator, original_frequency, new_frequency)
+    if len(station_data.index) != length:
+        return None
+    # if the UK is the operator then carry out QC check
+    if "COSMOS-UK" == operator:
+        station_data = qc_check_data(station_data)
+    # correct data - this needs updated!
+    station_data = apply_corrections(station_data, operator, station['rigidity'], data_keys, station['reference'])
+    # remove outlying data points
+    station_data = handle_outliers_interp(station_data, data_keys, 1, 97)
+
+    return station_data
+
+
+def average_network_data(folder_dict, start_date, stop_date, rigidity_range={'min': 0, 'max': 20},
+                         original_frequency='3600s', new_frequency='3600s', excluded_stations=[],
+                         network_weights=None, baseline_length=48, use_reference_table=False, metafile_format={},
+                         num_workers=4):
+    """
+    function to average data from several networks together. The stations of every network are listed together and
+    imported and corrected in one pass, with each station placed straight onto one shared time grid and normalised to
+    its own baseline so that instruments with different count rates can be combined. Each network is averaged across
+    its stations and the network averages are combined with a weight per network. A network without any valid
+    stations is skipped with a warning
+    :param folder_dict: dictionary of folder paths keyed by operator, e.g. {'COSMOS-UK': uk_path, 'NMDB': nm_path}
+    :param start_date: pandas datetime containing the start date of the range of data to be averaged
+    :param stop_date: pandas datetime containing the end date of the range of data to be averaged
+    :param rigidity_range: dictionary with 'min' and 'max' cutoff rigidities for stations to be accepted
+    :param original_frequency: string containing the original frequency of the data, or a dictionary of strings keyed
+    by operator if the networks differ
+    :param new_frequency: string specifying the frequency of the shared time grid
+    :param excluded_stations: list of station names to skip
+    :param network_weights: dictionary of weights keyed by operator. If None each network is weighted by its number
+    of contributing stations, which is the same as pooling all the stations
+    :param baseline_length: number of points at the start of the grid used as the baseline
+    :param use_reference_table: if True correct with the references stored in each folder by make_reference_table
+    :param metafile_format: dictionary keyed by operator of metafile key overrides for get_other_keys
+    :param num_workers: number of threads reading and correcting station files
+    :return: dataframe of the combined relative change and the relative change of each network, indexed by time, and
+    a dictionary of the contributing stations
+    """
+    grid = pd.date_range(start_date, stop_date, freq=new_frequency)
+
+    # one station list across every network, so that all the files are scheduled together
+    stations = []
+    for operator, folder_path in folder_dict.items():
+        stations.extend(list_stations(folder_path, operator, rigidity_range, excluded_stations, use_reference_table,
+                                      metafile_format.get(operator)))
+    results = process_stations(stations, start_date, stop_date, original_frequency, new_frequency, num_workers)
+
+    contributing_stations = {'name': [], 'rigidity': [], 'operator': []}
+    rows = []
+    for station, station_data in zip(stations, results):
+        if station_data is None:
+            continue
+        # the first data key is the moderated counts for every operator
+        key = get_data_keys(station['operator'])[0]
+        rows.append(reindex_to_grid(station_data[key].values, station_data.index, grid)[0])
+        contributing_stations['name'].append(station['name'])
+        contributing_stations['rigidity'].append(station['rigidity'])
+        contributing_stations['operator'].append(station['operator'])
+
+    if not rows:
+        raise ValueError('No valid stations found in any network for the rigidity range and dates given')
+
+    # normalise every station to its own baseline in one pass
+    counts = np.vstack(rows)
+    station_operator = np.array(contributing_stations['operator'])
+    baseline = np.nanmean(counts[:, 0:baseline_length], axis=1)
+    normalised = counts / baseline[:, None]
+
+    combined = {}
+    weighted_sum = np.zeros(len(grid))
+    weighted_err = np.zeros(len(grid))
+    weight_total = np.zeros(len(grid))
+    for operator in folder_dict:
+        in_network = station_operator == operator
+        if not in_network.any():
+            warnings.warn('No valid stations found for %s, it is left out of the combined average' % operator)
+            continue
+        if network_weights is None:
+            network_weight = np.count_nonzero(in_network)
+        else:
+            network_weight = network_weights[operator]
+
+        # average across the network
+        network_mean = np.nanmean(normalised[in_network], axis=0)
+        summed = np.nansum(counts[in_network], axis=0)
+        # percentage poisson error of the network average, NMDB rates having been converted to counts on import
+        network_err = np.multiply(np.divide(np.sqrt(summed), summed), 100)
+
+        combined[operator] = convert_to_rel_change(network_mean, baseline_length)
+        combined['E_' + operator] = network_err
+
+        # only networks with data at a time point contribute to the combined average there
+        weight = np.where(np.isnan(network_mean), 0, network_weight)
+        weighted_sum += weight * np.nan_to_num(network_mean)
+        weighted_err += (weight * np.nan_to_num(network_err)) ** 2
+        weight_total += weight
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average = weighted_sum / weight_total
+        combined['E_average'] = np.sqrt(weighted_err) / weight_total
+    average[weight_total == 0] = np.nan
+    combined['average'] = convert_to_rel_change(average, baseline_length)
+    combined['Time'] = grid
+
+    final_df = pd.DataFrame(combined)
+    final_df.set_index('Time', inplace=True)
 
-        # if the data is valid
-        if valid and not station_data.empty:
-            # resample the data
-            station_data = resample_data(station_data, operator, original_frequency, new_frequency)
-            if len(station_data.index) != length:
-                continue
-            # if the UK is the operator then carry out QC check
-            if "COSMOS-UK" == operator:
-                station_data = qc_check_data(station_data)
-            # correct data - this needs updated!
-            station_data = coscal.apply_corrections(station_data, operator, rigidity, data_keys)
-            # remove outlying data points
-            station_data = handle_outliers_interp(station_data, data_keys, 1, 97)
-
-            contributing_stations['name'].append(names[i])
-            contributing_stations['rigidity'].append(rigidity)
-
-            # add data to the array to be averaged - this probably needs a new function too because the difference in
-            # moderated and unmoderated counts from different networks
-            if first_station:
-                all_data = make_data_dict(station_data, data_keys)
-                first_station = False
-                index = station_data.index
-            else:
-
-                for key in data_keys:
-                    all_data[key] = np.vstack((all_data[key], station_data[key].values))
-
-    average = average_each_key(all_data, data_keys)
-    rel_change = dict_to_rel_change(average, data_keys)
+    return final_df, contributing_stations
+
+
+def reindex_to_grid(matrix, index, grid):
+    """
+    function to place the columns of a station x time array onto a time grid, leaving NaNs where there is no data
+    :param matrix: 2D array (station x time)
+    :param index: time index of the array columns
+    :param grid: pandas datetime index to place the data on
+    :return: 2D array (station x grid)
+    """
+    matrix = np.atleast_2d(matrix)
+    positions = grid.get_indexer(index)
+    on_grid = positions >= 0
+
+    gridded = np.full((matrix.shape[0], len(grid)), np.nan)
+    gridded[:, positions[on_grid]] = matrix[:, on_grid]
+
+    return gridded
+
+
+def make_reference_table(folder_path, operator, excluded_stations=[], metafile_format=None):
+    """
+    function to build the long term pressure and humidity references and attenuation length of every station in a
+    folder from the full record of each station. The table is saved in the folder as correction_reference.csv so it
+    only needs to be built once, and is used by collect_station_data when use_reference_table is True
+    :param folder_path: string containing system path to folder containing the data and the station_info.txt metafile
+    :param operator: string specifying the operator of the network supplying the data
+    :param excluded_stations: list of station names to skip
+    :param metafile_format: optional dictionary overriding the metafile keys from get_other_keys
+    :return: dataframe of the references indexed by station name
+    """
+    info, _ = read_station_info(folder_path, operator, metafile_format)
+
+    rows = {'name': [], 'CutoffRigidity': [], 'ReferencePressure': [], 'ReferenceHumidity': [],
+            'AttenuationLength': []}
+    for name, rigidity, filename in tqdm(list(zip(info['name'], info['rigidity'], info['filename']))):
+        if name in excluded_stations:
+            continue
+        # import the whole record rather than an event window
+        station_data, valid = import_neutron_data(filename, operator)
+        if not valid or station_data.empty:
+            continue
+        if "COSMOS-UK" == operator:
+            station_data = qc_check_data(station_data)
+
+        reference = make_reference_row(station_data, operator, rigidity)
+        rows['name'].append(name)
+        rows['CutoffRigidity'].append(rigidity)
+        for key in reference:
+            rows[key].append(reference[key])
+
+    reference_table = pd.DataFrame(rows)
+    reference_table.set_index('name', inplace=True)
+    reference_table.to_csv(os.path.join(folder_path, 'correction_reference.csv'))
+
+    return reference_table
+
+
+def make_average_frame(data_dict, index, data_keys, baseline_length=48):
+    """
+    function to average station x time arrays across stations and express the result as a relative change
+    :param data_dict: dictionary of 2D arrays (station x time) keyed by data key
+    :param index: time index of the arrays
+    :param data_keys: data keys
+    :param baseline_length: number of points at the start of the data used as the relative change baseline
+    :return: dataframe of the averaged relative change, indexed by time
+    """
+    average = average_each_key(data_dict, data_keys)
+    rel_change = dict_to_rel_change(average, data_keys, baseline_length)
     rel_change['Time'] = index
 
     final_df = pd.DataFrame(rel_change)
     final_df.set_index('Time', inplace=True)
 
-    return final_df, contributing_stations
+    return final_df
 
 
 def check_path_exists(path):
@@ -100,20 +469,27 @@ def check_path_exists(path):
     """
     ret_path = path
     while True:
-        if os.path.exists(path):
+        if os.path.exists(ret_path):
             break
         else:
-            ret_path = input("Path \"%s\" does not exist. Please enter a new path, or \"exit\" to terminate: " % path)
-            if path == 'exit':
+            ret_path = input("Path \"%s\" does not exist. Please enter a new path, or \"exit\" to terminate: "
+                             % ret_path)
+            if ret_path == 'exit':
                 exit(2)
 
     return ret_path
 
 
-def get_other_keys(operator):
+def get_other_keys(operator, metafile_format=None):
     """
     function to return a bunch of keys for opening metafiles and the like for a specified operator
-    :param operator: valid operators string: one on 'COSMOS-UK' and 'COSMOS-US'
+    :param operator: valid operators string: one of 'COSMOS-UK', 'COSMOS-US' and 'NMDB'
+    :param metafile_format: optional dictionary overriding any of the returned keys. The NMDB defaults are for a
+    station_info.txt written like the NMDB exports: ';' separated with the station names in a 'Station' column, one
+    '<name>.txt' file per station, and hourly values that include the stop time (length_mod 1). NMDB files hold count
+    rates (counts/s), so count_rate is True and the rates are converted to counts per original time step on import,
+    which keeps the poisson errors right. Pass a dictionary here if your NMDB files differ, e.g. {'count_rate': False}
+    for files that already hold counts
     :return: dictionary of key strings
     """
 
@@ -123,12 +499,24 @@ def get_other_keys(operator):
         ret_dict['name_column'] = 'SiteName'
         ret_dict['length_mod'] = 0
         ret_dict['extension'] = '.txt'
+        ret_dict['count_rate'] = False
 
     elif "COSMOS-UK" == operator:
         ret_dict['meta_sep'] = ','
         ret_dict['name_column'] = 'SITE_ID'
         ret_dict['length_mod'] = 1
         ret_dict['extension'] = '.csv'
+        ret_dict['count_rate'] = False
+
+    elif "NMDB" == operator:
+        ret_dict['meta_sep'] = ';'
+        ret_dict['name_column'] = 'Station'
+        ret_dict['length_mod'] = 1
+        ret_dict['extension'] = '.txt'
+        ret_dict['count_rate'] = True
+
+    if metafile_format is not None:
+        ret_dict.update(metafile_format)
 
     return ret_dict
 
@@ -169,7 +557,7 @@ def resample_data(data, operator, original_frequency, new_frequency):
         resampled_data = data.resample(new_frequency).nearest()
 
     # otherwise if the new frequency is larger than the old data
-    elif new_frequency > original_frequency:
+    elif new_frequency_td > original_frequency_td:
         # check if it is a multiple of the old data
         if is_multiple(new_frequency_td, original_frequency_td):
             # if so, pass the operator string to a function to create a dictionary containing resampling instructions
@@ -194,7 +582,56 @@ def is_multiple(large_td, small_td):
     :param small_td: the smaller timedelta
     :return:
     """
-    return large_td % small_td == pd.Timedelta('0T')
+    return large_td % small_td == pd.Timedelta(0)
+
+
+def aggregate_data_dict(data_dict, index, keys, new_frequency, resampler_dict, base_frequency):
+    """
+    function to aggregate station x time arrays to a coarser frequency without going back through pandas resampling.
+    Columns falling in the same time bin are combined with the method given for the key in resampler_dict. Bins at
+    the edges that hold fewer than new_frequency / base_frequency columns are dropped, since summed counts in a partly
+    filled bin would look like a decrease
+    :param data_dict: dictionary of 2D arrays (station x time) keyed by data key
+    :param index: pandas datetime index of the arrays
+    :param keys: data keys to aggregate
+    :param new_frequency: the frequency to aggregate to
+    :param resampler_dict: dictionary of 'sum' or 'mean' for each key, as from get_resampler_dict
+    :param base_frequency: the frequency of the columns of the arrays
+    :return: dictionary of aggregated arrays and the new time index
+    """
+    # label each column by the bin it falls in, and find where each bin starts
+    labels = index.floor(new_frequency)
+    bin_starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    # count the columns in each bin and keep only the full ones
+    bin_size = np.add.reduceat(np.ones(len(index), dtype=int), bin_starts)
+    full_bin = bin_size >= pd.Timedelta(new_frequency) / pd.Timedelta(base_frequency)
+
+    agg_dict = {}
+    for key in keys:
+        aggregated = aggregate_matrix(np.atleast_2d(data_dict[key]), bin_starts, resampler_dict[key])
+        agg_dict[key] = aggregated[:, full_bin]
+
+    return agg_dict, labels[bin_starts][full_bin]
+
+
+def aggregate_matrix(matrix, bin_starts, method):
+    """
+    function to sum or average contiguous column blocks of a 2D array, skipping NaNs as pandas resampling does
+    :param matrix: 2D array (station x time)
+    :param bin_starts: array of the column index at which each block starts
+    :param method: 'sum' or 'mean'
+    :return: 2D array (station x number of blocks)
+    """
+    valid = ~np.isnan(matrix)
+    summed = np.add.reduceat(np.where(valid, matrix, 0), bin_starts, axis=1)
+    if method == 'sum':
+        return summed
+    elif method == 'mean':
+        num_valid = np.add.reduceat(valid.astype(int), bin_starts, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return summed / num_valid
+    else:
+        raise ValueError('%s is not a valid aggregation method' % method)
 
 
 def get_resampler_dict(operator):
@@ -296,9 +733,9 @@ def handle_outliers_interp(data, keys, min_percentile, max_percentile):
     """
 
     for key in keys:
-        # convert the outliers to NaN values
-        data[key] = outliers_to_nans(data[key].values, min_percentile, max_percentile)
-        data[key] = interp_nans(data[key].values)
+        # convert the outliers to NaN values, on a float copy since integer counts can't hold NaN
+        values = outliers_to_nans(data[key].values.astype(float), min_percentile, max_percentile)
+        data[key] = interp_nans(values)
 
     return data
 
@@ -339,24 +776,6 @@ def outliers_to_nans(data, min_percentile, max_percentile):
     return data
 
 
-def make_data_dict(data, keys):
-    """
-    function to make a dictionary containing empty arrays for data to be averaged, with different
-    :param data:
-    :param keys: list of strings containing data keys
-    :return: dictionary containing initialised arrays
-    """
-
-    # initialise the dictionary
-    data_dict = {}
-
-    # loop through the keys adding an empty array to the dictionary for each
-    for key in keys:
-        data_dict[key] = data[key].values
-
-    return data_dict
-
-
 def calculate_poisson_percentage(data_dict, error_keys, data_keys):
     """
 
@@ -393,25 +812,27 @@ def average_each_key(data_dict, keys):
     return average
 
 
-def dict_to_rel_change(data_dict, keys):
+def dict_to_rel_change(data_dict, keys, baseline_length=48):
     """
     convert data in a dict to relative change from counts
     :param data_dict: dictionary containing the data
     :param keys: data keys
+    :param baseline_length: number of points at the start of the data used as the baseline
     :return:
     """
     rel_change = {}
     for key in keys:
-        rel_change[key] = convert_to_rel_change(data_dict[key])
-        rel_change[key + '_std'] = normalise_std(data_dict[key + '_std'], data_dict[key])
+        rel_change[key] = convert_to_rel_change(data_dict[key], baseline_length)
+        # the poisson error from average_each_key is already a percentage
+        rel_change['E_' + key] = data_dict['E_' + key]
     return rel_change
 
 
-def convert_to_rel_change(data):
+def convert_to_rel_change(data, baseline_length=48):
     # one day I'll introduce docstrings and validation checks. One day.
 
     # find the data mean
-    data_mean = np.nanmean(data[0:48])
+    data_mean = np.nanmean(data[0:baseline_length])
 
     # find the difference from the mean at each data point
     change = data - data_mean
@@ -421,10 +842,3 @@ def convert_to_rel_change(data):
 
     # return the new data expressed as a relative change from the mean
     return rel_change
-
-
-def normalise_std(std_array, data_array):
-
-    normal_std = std_array/data_array * 100
-
-    return normal_std
@@ -0,0 +1,218 @@
+import numpy as np
+import pandas as pd
+from datahandling.average_data import collect_station_data, get_data_keys
+
+
+def station_fd_table(folder_path, operator, start_date, stop_date, rigidity_range={'min': 0, 'max': 20},
+                     original_frequency='3600s', new_frequency='3600s', excluded_stations=[], baseline_length=48,
+                     smoothing_window=24, use_reference_table=False, metafile_format=None):
+    """
+    function to import and correct every accepted station in a folder and calculate the Forbush decrease response of
+    each station individually
+    :param folder_path: string containing system path to folder containing the data and the station_info.txt metafile
+    :param operator: string specifying the operator of the network supplying the data
+    :param start_date: pandas datetime containing the start date of the event
+    :param stop_date: pandas datetime containing the end date of the event
+    :param rigidity_range: dictionary with 'min' and 'max' cutoff rigidities for stations to be accepted
+    :param original_frequency: string containing the original frequency of the data
+    :param new_frequency: string specifying the time resolution of the analysis
+    :param excluded_stations: list of station names to skip
+    :param baseline_length: number of points at the start of the data used as the pre-event baseline
+    :param smoothing_window: number of points in the running mean applied before finding the minimum
+    :param use_reference_table: if True correct with the references stored in the folder by make_reference_table
+    :param metafile_format: optional dictionary overriding the metafile keys from get_other_keys
+    :return: dataframe with one row per station (see fd_amplitude_table) and a dictionary of relative change dataframes
+    (time x station) keyed by data key
+    """
+    all_data, index, contributing_stations = collect_station_data(folder_path, operator, start_date, stop_date,
+                                                                  rigidity_range, original_frequency, new_frequency,
+                                                                  excluded_stations, use_reference_table,
+                                                                  metafile_format)
+    data_keys = get_data_keys(operator)
+
+    return fd_amplitude_table(all_data, index, contributing_stations, data_keys, baseline_length, smoothing_window)
+
+
+def fd_amplitude_table(data_dict, index, contributing_stations, data_keys, baseline_length=48, smoothing_window=24,
+                       onset_fraction=0.1, recovery_fraction=0.5):
+    """
+    function to calculate the Forbush decrease amplitude, onset and recovery of every station at once from station x
+    time count arrays. The counts are first smoothed with a centred running mean so that single noisy points are not
+    taken as the minimum, and the minimum is only searched for after the baseline. Amplitudes are positive percentage
+    decreases from the baseline mean, with uncertainties propagated from poisson errors on the counts in the smoothing
+    window at the minimum and in the baseline.
+    The onset is the last point before the minimum where the smoothed decrease was smaller than onset_fraction *
+    amplitude, and the recovery is the first point after the minimum where the smoothed decrease is back below
+    recovery_fraction * amplitude. The uncertainty on each of these times is half the span of points where the smoothed
+    curve is within 1 sigma of the threshold (or of the minimum), and at least half the time resolution.
+    Stations with no data after the baseline get NaN amplitudes and NaT times
+    :param data_dict: dictionary of 2D arrays (station x time) keyed by data key, as from collect_station_data
+    :param index: time index of the arrays
+    :param contributing_stations: dictionary with the 'name' and 'rigidity' of each row of the arrays
+    :param data_keys: data keys
+    :param baseline_length: number of points at the start of the data used as the pre-event baseline
+    :param smoothing_window: number of points in the running mean applied before finding the minimum, onset and
+    recovery. 1 turns the smoothing off
+    :param onset_fraction: fraction of the amplitude used to define the onset
+    :param recovery_fraction: fraction of the amplitude used to define the recovery
+    :return: dataframe with one row per station, indexed by name and containing the CutoffRigidity, and a dictionary
+    of relative change dataframes (time x station) keyed by data key, with their poisson errors keyed by 'E_' + key
+    """
+    table = pd.DataFrame({'CutoffRigidity': contributing_stations['rigidity']},
+                         index=pd.Index(contributing_stations['name'], name='name'))
+    time = pd.DatetimeIndex(index)
+    rel_changes = {}
+
+    for key in data_keys:
+        counts = np.atleast_2d(data_dict[key]).astype(float)
+        num_stations, num_points = counts.shape
+        if baseline_length >= num_points:
+            raise ValueError('The baseline of %d points leaves no data to find a decrease in' % baseline_length)
+        stations = np.arange(num_stations)
+        positions = np.arange(num_points)
+        resolution = (time[1] - time[0]).total_seconds() if num_points > 1 else 0
+        seconds = (time - time[0]).total_seconds().values
+
+        # relative change from the baseline mean of each station, and its poisson error
+        baseline = np.nanmean(counts[:, 0:baseline_length], axis=1)
+        num_baseline = np.count_nonzero(~np.isnan(counts[:, 0:baseline_length]), axis=1)
+        baseline_var = 1 / (num_baseline * baseline)
+        ratio = counts / baseline[:, None]
+        rel_change = (ratio - 1) * 100
+        rel_change_err = ratio * 100 * np.sqrt(1 / counts + baseline_var[:, None])
+
+        # smoothed curve, with the error from the total counts in each window
+        smooth_counts, window_points = running_mean(counts, smoothing_window)
+        smooth_ratio = smooth_counts / baseline[:, None]
+        smooth_rel = (smooth_ratio - 1) * 100
+        smooth_err = smooth_ratio * 100 * np.sqrt(1 / (smooth_counts * window_points) + baseline_var[:, None])
+
+        # the minimum of each station's smoothed curve after the baseline gives the amplitude
+        # checked on the raw curve, as the smoothing window carries baseline points past the end of the baseline
+        has_data = np.isfinite(rel_change[:, baseline_length:]).any(axis=1)
+        min_pos = np.nanargmin(np.where(positions[None, :] < baseline_length, np.inf, smooth_rel), axis=1)
+        amplitude = np.where(has_data, -smooth_rel[stations, min_pos], np.nan)
+        amplitude_err = np.where(has_data, smooth_err[stations, min_pos], np.nan)
+        after_baseline = positions[None, :] >= baseline_length
+        near_min = after_baseline & (smooth_rel <= (-amplitude + amplitude_err)[:, None])
+        min_err = span_error(near_min, seconds, resolution)
+
+        # onset: last point before the minimum still within onset_fraction of the amplitude of the baseline
+        onset_threshold = -onset_fraction * amplitude[:, None]
+        before_min = positions[None, :] < min_pos[:, None]
+        pre_onset = before_min & (smooth_rel >= onset_threshold)
+        onset_pos = num_points - 1 - np.argmax(pre_onset[:, ::-1], axis=1)
+        onset_pos = np.where(pre_onset.any(axis=1), onset_pos, 0)
+        onset_err = span_error(before_min & (np.abs(smooth_rel - onset_threshold) <= smooth_err), seconds, resolution)
+
+        # recovery: first point after the minimum where the decrease has shrunk to recovery_fraction of the amplitude
+        recovery_threshold = -recovery_fraction * amplitude[:, None]
+        after_min = positions[None, :] > min_pos[:, None]
+        recovered = after_min & (smooth_rel >= recovery_threshold)
+        has_recovered = recovered.any(axis=1)
+        recovery_pos = np.argmax(recovered, axis=1)
+        recovery_err = span_error(after_min & (np.abs(smooth_rel - recovery_threshold) <= smooth_err), seconds,
+                                  resolution)
+
+        # fraction of the amplitude that has been recovered by the end of the data
+        end_recovery = (smooth_rel[:, -1] + amplitude) / amplitude
+
+        table[key + '_amplitude'] = amplitude
+        table['E_' + key + '_amplitude'] = amplitude_err
+        table[key + '_onset_time'] = time[onset_pos].where(has_data)
+        table['E_' + key + '_onset_time'] = pd.to_timedelta(onset_err, unit='s').where(has_data)
+        table[key + '_minimum_time'] = time[min_pos].where(has_data)
+        table['E_' + key + '_minimum_time'] = pd.to_timedelta(min_err, unit='s').where(has_data)
+        table[key + '_fall_time'] = (time[min_pos] - time[onset_pos]).where(has_data)
+        table['E_' + key + '_fall_time'] = pd.to_timedelta(np.hypot(onset_err, min_err), unit='s').where(has_data)
+        table[key + '_recovery_time'] = (time[recovery_pos] - time[min_pos]).where(has_recovered & has_data)
+        table['E_' + key + '_recovery_time'] = pd.to_timedelta(np.hypot(recovery_err, min_err),
+                                                               unit='s').where(has_recovered & has_data)
+        table[key + '_end_recovery'] = end_recovery
+
+        rel_changes[key] = pd.DataFrame(rel_change.T, index=time, columns=table.index)
+        rel_changes['E_' + key] = pd.DataFrame(rel_change_err.T, index=time, columns=table.index)
+
+    return table, rel_changes
+
+
+def running_mean(matrix, window):
+    """
+    function to take a centred running mean along the time axis of a station x time array using cumulative sums.
+    NaNs are skipped, and the window is cut short at the ends of the array
+    :param matrix: 2D array (station x time)
+    :param window: number of points in the window
+    :return: array of the running mean and array of the number of valid points in each window
+    """
+    valid = ~np.isnan(matrix)
+    num_points = matrix.shape[1]
+    summed = np.concatenate((np.zeros((matrix.shape[0], 1)), np.cumsum(np.where(valid, matrix, 0), axis=1)), axis=1)
+    counted = np.concatenate((np.zeros((matrix.shape[0], 1)), np.cumsum(valid, axis=1)), axis=1)
+
+    lower = np.clip(np.arange(num_points) - window // 2, 0, num_points)
+    upper = np.clip(lower + window, 0, num_points)
+    window_points = counted[:, upper] - counted[:, lower]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (summed[:, upper] - summed[:, lower]) / window_points
+
+    return mean, window_points
+
+
+def span_error(mask, seconds, resolution):
+    """
+    function to turn a station x time mask of the points consistent with a time (e.g. within 1 sigma of a threshold)
+    into an uncertainty on that time of half the span of the masked points
+    :param mask: 2D boolean array (station x time)
+    :param seconds: array of the time of each point in seconds
+    :param resolution: time resolution in seconds, half of which is the smallest uncertainty returned
+    :return: array of uncertainties in seconds
+    """
+    first = np.argmax(mask, axis=1)
+    last = mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1)
+    span = np.where(mask.any(axis=1), seconds[last] - seconds[first], 0)
+
+    return np.maximum(span, resolution) / 2
+
+
+def fit_amplitude_rigidity(table, key):
+    """
+    function to fit a weighted straight line of Forbush decrease amplitude against cutoff rigidity, weighting each
+    station by the inverse square of its amplitude uncertainty
+    :param table: dataframe from fd_amplitude_table
+    :param key: data key to fit the amplitudes of
+    :return: dictionary containing the intercept, slope, their uncertainties and the reduced chi squared
+    """
+    rigidity = table['CutoffRigidity'].values.astype(float)
+    amplitude = table[key + '_amplitude'].values.astype(float)
+    weight = 1 / table['E_' + key + '_amplitude'].values.astype(float) ** 2
+
+    # drop stations that can't contribute to the fit
+    valid = np.isfinite(rigidity) & np.isfinite(amplitude) & np.isfinite(weight)
+    rigidity, amplitude, weight = rigidity[valid], amplitude[valid], weight[valid]
+    if len(rigidity) < 2:
+        raise ValueError('At least two stations are needed to fit %s amplitude against rigidity' % key)
+
+    # closed form weighted least squares
+    s = np.sum(weight)
+    s_x = np.sum(weight * rigidity)
+    s_y = np.sum(weight * amplitude)
+    s_xx = np.sum(weight * rigidity ** 2)
+    s_xy = np.sum(weight * rigidity * amplitude)
+    delta = s * s_xx - s_x ** 2
+
+    intercept = (s_xx * s_y - s_x * s_xy) / delta
+    slope = (s * s_xy - s_x * s_y) / delta
+
+    residuals = amplitude - (intercept + slope * rigidity)
+    dof = len(rigidity) - 2
+    chi2_red = np.sum(weight * residuals ** 2) / dof if dof > 0 else np.nan
+
+    ret_dict = {'intercept': intercept,
+                'slope': slope,
+                'E_intercept': np.sqrt(s_xx / delta),
+                'E_slope': np.sqrt(s / delta),
+                'chi2_red': chi2_red,
+                'num_stations': len(rigidity)
+                }
+
+    return ret_dict
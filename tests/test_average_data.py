@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+from datahandling.average_data import aggregate_data_dict, get_resampler_dict
+
+
+def make_station_frames(num_stations=3, start='2020-01-01 05:00', stop='2020-01-05 00:00'):
+    """
+    function to make hourly COSMOS-US style station frames that start part way through a day and end on the stop
+    midnight, so that the first and last daily bins are only partly filled
+    """
+    rng = np.random.default_rng(0)
+    index = pd.date_range(start, stop, freq='h')
+    frames = []
+    for _ in range(num_stations):
+        frame = pd.DataFrame({key: rng.normal(1000, 30, len(index)) for key in get_resampler_dict('COSMOS-US')},
+                             index=index)
+        frame.iloc[7, 0] = np.nan
+        frames.append(frame)
+    return frames, index
+
+
+def test_aggregate_data_dict_matches_pandas_resample():
+    frames, index = make_station_frames()
+    resampler_dict = get_resampler_dict('COSMOS-US')
+    keys = list(resampler_dict)
+    data_dict = {key: np.vstack([frame[key].values for frame in frames]) for key in keys}
+
+    for frequency in ['3h', '1D']:
+        agg_dict, agg_index = aggregate_data_dict(data_dict, index, keys, frequency, resampler_dict, '1h')
+
+        expected = [frame.resample(frequency).agg(resampler_dict) for frame in frames]
+        # only the bins holding every hour survive
+        full = frames[0].resample(frequency).size() == pd.Timedelta(frequency) / pd.Timedelta('1h')
+        pd.testing.assert_index_equal(agg_index, expected[0].index[full.values], check_names=False)
+        for key in keys:
+            np.testing.assert_allclose(agg_dict[key], np.vstack([frame[key].values[full.values]
+                                                                 for frame in expected]))
+
+
+def test_aggregate_data_dict_drops_partial_edge_bins():
+    frames, index = make_station_frames()
+    resampler_dict = get_resampler_dict('COSMOS-US')
+    data_dict = {'MOD': np.vstack([frame['MOD'].values for frame in frames])}
+
+    agg_dict, agg_index = aggregate_data_dict(data_dict, index, ['MOD'], '1D', resampler_dict, '1h')
+
+    # the day starting at 05:00 and the single midnight point at the stop are both dropped
+    assert list(agg_index) == list(pd.date_range('2020-01-02', '2020-01-04', freq='D'))
+    assert agg_dict['MOD'].shape == (3, 3)
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+from datahandling.fd_amplitude import fd_amplitude_table, fit_amplitude_rigidity
+
+
+def make_step_and_recover(amplitudes, num_points=240, level=1e6, drop=72, plateau=96, recovered=192):
+    """
+    function to make hourly station x time counts that drop by each amplitude (%) at drop, stay down until plateau
+    and then recover linearly to the baseline level at recovered
+    """
+    shape = np.ones(num_points)
+    shape[drop:plateau] = 0
+    shape[plateau:recovered] = np.linspace(0, 1, recovered - plateau, endpoint=False)
+    counts = np.array([level * (1 - amplitude / 100 * (1 - shape)) for amplitude in amplitudes])
+    index = pd.date_range('2020-01-01', periods=num_points, freq='h')
+    stations = {'name': ['S%d' % i for i in range(len(amplitudes))],
+                'rigidity': [2.0 * i for i in range(len(amplitudes))]}
+    return counts, index, stations
+
+
+def test_step_and_recover_times_and_amplitude():
+    counts, index, stations = make_step_and_recover([2, 5, 10])
+    table, rel_changes = fd_amplitude_table({'MOD': counts}, index, stations, ['MOD'], smoothing_window=1,
+                                            recovery_fraction=0.55)
+
+    np.testing.assert_allclose(table['MOD_amplitude'].values, [2, 5, 10])
+    assert (table['MOD_onset_time'] == index[71]).all()
+    assert (table['MOD_minimum_time'] == index[72]).all()
+    assert (table['MOD_fall_time'] == pd.Timedelta('1h')).all()
+    # 45% of the decrease is recovered 44 points up the 96 point linear recovery
+    assert (table['MOD_recovery_time'] == index[140] - index[72]).all()
+    np.testing.assert_allclose(table['MOD_end_recovery'].values, 1)
+    assert rel_changes['MOD'].shape == (240, 3)
+    assert (rel_changes['E_MOD'].values > 0).all()
+
+
+def test_no_recovery_gives_nat():
+    counts, index, stations = make_step_and_recover([5], recovered=240)
+    counts[:, 96:] = counts[0, 72]
+    table, _ = fd_amplitude_table({'MOD': counts}, index, stations, ['MOD'], smoothing_window=1)
+
+    assert pd.isna(table['MOD_recovery_time'].iloc[0])
+    assert pd.isna(table['E_MOD_recovery_time'].iloc[0])
+
+
+def test_noisy_baseline_dip_is_not_the_minimum():
+    rng = np.random.default_rng(1)
+    counts, index, stations = make_step_and_recover([3, 3], level=3000)
+    counts = rng.poisson(counts).astype(float)
+    # a single deep dip inside the baseline
+    counts[:, 10] *= 0.9
+    table, _ = fd_amplitude_table({'MOD': counts}, index, stations, ['MOD'])
+
+    # the smoothed minimum lies on the plateau, give or take half the smoothing window
+    minimum_time = table['MOD_minimum_time']
+    assert ((minimum_time >= index[60]) & (minimum_time < index[108])).all()
+    assert (np.abs(table['MOD_amplitude'] - 3) < 3 * table['E_MOD_amplitude'] + 0.5).all()
+    assert (table['E_MOD_onset_time'] >= pd.Timedelta('30min')).all()
+
+
+def test_fit_amplitude_rigidity_recovers_line():
+    table = pd.DataFrame({'CutoffRigidity': [1.0, 2.0, 3.0, 4.0],
+                          'MOD_amplitude': [9.0, 8.0, 7.0, 6.0],
+                          'E_MOD_amplitude': [0.5, 0.5, 0.5, 0.5]})
+    fit = fit_amplitude_rigidity(table, 'MOD')
+
+    np.testing.assert_allclose([fit['intercept'], fit['slope']], [10, -1])
+    assert fit['num_stations'] == 4
+
+
+def test_station_without_data_after_baseline_gives_nan():
+    counts, index, stations = make_step_and_recover([5, 5])
+    counts[1, 48:] = np.nan
+    table, _ = fd_amplitude_table({'MOD': counts}, index, stations, ['MOD'])
+
+    assert np.isfinite(table['MOD_amplitude'].iloc[0])
+    assert np.isnan(table['MOD_amplitude'].iloc[1])
+    assert np.isnan(table['E_MOD_amplitude'].iloc[1])
+    assert pd.isna(table['MOD_minimum_time'].iloc[1])
+    assert pd.isna(table['MOD_onset_time'].iloc[1])
+    assert pd.isna(table['MOD_recovery_time'].iloc[1])